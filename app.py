@@ -2,200 +2,302 @@ import streamlit as st
 import pandas as pd
 from datetime import datetime
 import re
-import uuid
+import secrets
+import sys
+import time
+
+_now_ns = time.time_ns
+_REF_RE = re.compile(r'GG-LEGAL-\d{4}-\d{4}')
+_REPLY_PREFIX_RE = re.compile(r'^\s*(RE|FWD?)\s*:\s*', re.IGNORECASE)
+
+_DEFAULT_SENDER = "citlegalsupport@greatgray.com"
+_DEFAULT_RECIPIENT = "client@company.com"
+_DEFAULT_BODY = """Thank you for contacting the Great Gray CIT Support Legal Mailbox.
+
+As a team, we strive to process and provide legal services within a minimum of five (5) business days.
+In some cases, time sensitive matters may receive a higher priority of service.
+As a result, certain legal service requests may take more than five (5) business days.
+Additionally, our processing timeline will vary depending on the nature of the request and the availability of information/documents necessary for review.
+
+A member of Great Gray Legal Team will contact you soon regarding this request, but in the meantime, if you need to contact us with questions or provide additional information regarding this matter, *please reference the number in the subject line on all correspondence.*
+
+We look forward to servicing your request.
+
+The Great Gray CIT Legal Team"""
+
+_FOOTER = """
+### 💡 How This System Works:
+
+1. **Automatic Reference Numbers**: Each new email thread gets a unique reference number (GG-LEGAL-YYYY-NNNN format)
+2. **Subject Line Integration**: Reference numbers are automatically added to subject lines
+3. **Thread Tracking**: All replies with the same reference number are grouped together
+4. **Easy Search**: Find any email by its reference number
+5. **Sequential Numbering**: Each reply in a thread can be easily identified by position
+
+### Benefits:
+- ✅ No more scrolling through dozens of emails
+- ✅ Quick reference for clients and team members  
+- ✅ Professional tracking system
+- ✅ Easy handoffs between team members
+- ✅ Audit trail for legal matters
+"""
 
 # Initialize session state
 if 'email_chains' not in st.session_state:
     st.session_state.email_chains = []
 if 'next_ref_number' not in st.session_state:
     st.session_state.next_ref_number = 1
+if 'thread_counts' not in st.session_state:
+    st.session_state.thread_counts = {}
+if 'emails_by_ref' not in st.session_state:
+    st.session_state.emails_by_ref = {}
+
+
+def format_reference_number(year, number):
+    """Format a reference number as GG-LEGAL-YYYY-NNNN"""
+    return f"GG-LEGAL-{year}-{number:04d}"
 
 
 def generate_reference_number():
     """Generate a reference number in format: GG-LEGAL-YYYY-NNNN"""
-    year = datetime.now().year
-    ref_num = f"GG-LEGAL-{year}-{st.session_state.next_ref_number:04d}"
+    ref_num = format_reference_number(datetime.now().year, st.session_state.next_ref_number)
     st.session_state.next_ref_number += 1
     return ref_num
 
 
 def extract_reference_from_subject(subject):
     """Extract reference number from subject line"""
-    pattern = r'GG-LEGAL-\d{4}-\d{4}'
-    match = re.search(pattern, subject)
+    # Fast path: subjects we generate carry the reference as "[GG-LEGAL-YYYY-NNNN]"
+    # Only taken when no unbracketed reference precedes it, so the first match still wins
+    start = subject.find('[GG-LEGAL-')
+    if start != -1 and 'GG-LEGAL-' not in subject[:start]:
+        end = subject.find(']', start)
+        if end - start == 19:
+            ref = subject[start + 1:end]
+            # isdecimal() accepts exactly the characters the regex's \d does
+            if ref[9:13].isdecimal() and ref[13] == '-' and ref[14:].isdecimal():
+                return ref
+
+    match = _REF_RE.search(subject)
     return match.group() if match else None
 
 
-def add_email_to_chain(sender, recipient, subject, body, ref_number=None):
+def add_email_to_chain(sender, recipient, subject, body, ref_number=None, timestamp_ns=None):
     """Add an email to the chain"""
-    # If no reference number provided, check if subject contains one
-    if not ref_number:
+    if ref_number:
+        # Caller chose the thread; the subject may or may not already name it
+        needs_prefix = ref_number not in subject
+    else:
+        # If no reference number provided, check if subject contains one
         ref_number = extract_reference_from_subject(subject)
-
-    # If still no reference number, generate a new one
-    if not ref_number:
-        ref_number = generate_reference_number()
+        # If still no reference number, generate a new one
+        needs_prefix = not ref_number
+        if needs_prefix:
+            ref_number = generate_reference_number()
 
     # Ensure reference number is in subject line
-    if ref_number not in subject:
-        if subject.startswith("RE:"):
-            subject = f"RE: [{ref_number}] {subject[3:].strip()}"
+    if needs_prefix:
+        reply_prefix = _REPLY_PREFIX_RE.match(subject)
+        if reply_prefix:
+            subject = f"RE: [{ref_number}] {subject[reply_prefix.end():]}"
         else:
             subject = f"[{ref_number}] {subject}"
 
+    # Senders, recipients and references repeat across emails; share one string each
+    sender = sys.intern(sender)
+    recipient = sys.intern(recipient)
+    ref_number = sys.intern(ref_number)
+
+    thread_position = st.session_state.thread_counts.get(ref_number, 0) + 1
+    st.session_state.thread_counts[ref_number] = thread_position
+
     email = {
-        'id': str(uuid.uuid4())[:8],
-        'timestamp': datetime.now(),
+        'id': secrets.token_hex(4),
+        'timestamp_ns': _now_ns() if timestamp_ns is None else timestamp_ns,
         'sender': sender,
         'recipient': recipient,
         'subject': subject,
         'body': body,
         'reference_number': ref_number,
-        'thread_position': len([e for e in st.session_state.email_chains if e['reference_number'] == ref_number]) + 1
+        'thread_position': thread_position
     }
 
     st.session_state.email_chains.append(email)
+    st.session_state.emails_by_ref.setdefault(ref_number, []).append(email)
     return email
 
 
+def add_emails_batch(rows):
+    """Add several emails at once, reading the clock a single time"""
+    start_ns = _now_ns()
+    return [add_email_to_chain(row['sender'], row['recipient'], row['subject'], row['body'],
+                               row.get('ref_number'), start_ns + i * 1000)
+            for i, row in enumerate(rows)]
+
+
+def format_timestamp(timestamp_ns, fmt):
+    """Format an epoch-nanosecond timestamp for display"""
+    return datetime.fromtimestamp(timestamp_ns / 1e9).strftime(fmt)
+
+
 def get_emails_by_reference(ref_number):
     """Get all emails with a specific reference number"""
-    return [e for e in st.session_state.email_chains if e['reference_number'] == ref_number]
+    return st.session_state.emails_by_ref.get(ref_number, [])
 
 
 def get_unique_references():
     """Get all unique reference numbers"""
-    return list(set([e['reference_number'] for e in st.session_state.email_chains]))
+    return list(st.session_state.emails_by_ref)
 
 
-# Streamlit UI
-st.title("📧 Email Reference Number System")
-st.markdown("*POC for Great Gray CIT Legal Team*")
+def get_sorted_references():
+    """Get unique reference numbers in display order, re-sorted only after new emails"""
+    n_emails = len(st.session_state.email_chains)
+    cached = st.session_state.get('sorted_refs')
+    if cached is None or cached[0] != n_emails:
+        cached = (n_emails, sorted(get_unique_references()))
+        st.session_state.sorted_refs = cached
+    return cached[1]
 
-# Sidebar for controls
-st.sidebar.header("📊 System Stats")
-st.sidebar.metric("Total Emails", len(st.session_state.email_chains))
-st.sidebar.metric("Active Threads", len(get_unique_references()))
-st.sidebar.markdown("**Next Reference #**")
-st.sidebar.markdown(f'<small>{f"GG-LEGAL-{datetime.now().year}-{st.session_state.next_ref_number:04d}"}</small>', unsafe_allow_html=True)
 
-if st.sidebar.button("🗑️ Clear All Data"):
+def _send_email():
+    """Send the composed email; runs as the Send button callback"""
+    state = st.session_state
+    ref_to_use = state.get('compose_ref') if state.compose_is_reply else None
+    state.last_sent = add_email_to_chain(state.compose_sender, state.compose_recipient,
+                                         state.compose_subject, state.compose_body, ref_to_use)
+
+
+def _clear_all_data():
+    """Reset all emails and counters; runs as the Clear button callback"""
     st.session_state.email_chains = []
     st.session_state.next_ref_number = 1
-    st.success("✅ All data cleared!")
+    st.session_state.thread_counts = {}
+    st.session_state.emails_by_ref = {}
+    st.session_state.pop('sorted_refs', None)
 
-# Main tabs
-tab1, tab2, tab3 = st.tabs(["📝 Compose Email", "📨 Email Threads", "🔍 Search by Reference"])
 
-with tab1:
+@st.fragment
+def render_compose_tab():
+    """Compose tab; typing here reruns only this fragment"""
     st.header("Compose New Email")
 
     col1, col2 = st.columns(2)
     with col1:
-        sender = st.text_input("From:", value="citlegalsupport@greatgray.com")
-        recipient = st.text_input("To:", value="client@company.com")
+        st.text_input("From:", value=_DEFAULT_SENDER, key="compose_sender")
+        st.text_input("To:", value=_DEFAULT_RECIPIENT, key="compose_recipient")
 
     with col2:
-        is_reply = st.checkbox("This is a reply to existing thread")
+        is_reply = st.checkbox("This is a reply to existing thread", key="compose_is_reply")
         if is_reply:
-            existing_refs = get_unique_references()
-            if existing_refs:
-                selected_ref = st.selectbox("Select Reference Number:", existing_refs)
+            references = get_sorted_references()
+            if references:
+                st.selectbox("Select Reference Number:", references, key="compose_ref")
             else:
                 st.warning("No existing threads to reply to")
-                selected_ref = None
-        else:
-            selected_ref = None
 
-    subject = st.text_input("Subject:", value="Legal Service Request")
-    body = st.text_area("Email Body:",
-                        value="""Thank you for contacting the Great Gray CIT Support Legal Mailbox.
+    st.text_input("Subject:", value="Legal Service Request", key="compose_subject")
+    st.text_area("Email Body:", value=_DEFAULT_BODY, height=200, key="compose_body")
 
-As a team, we strive to process and provide legal services within a minimum of five (5) business days.
-In some cases, time sensitive matters may receive a higher priority of service.
-As a result, certain legal service requests may take more than five (5) business days.
-Additionally, our processing timeline will vary depending on the nature of the request and the availability of information/documents necessary for review.
-
-A member of Great Gray Legal Team will contact you soon regarding this request, but in the meantime, if you need to contact us with questions or provide additional information regarding this matter, *please reference the number in the subject line on all correspondence.*
-
-We look forward to servicing your request.
-
-The Great Gray CIT Legal Team""",
-                        height=200)
+    if st.button("📤 Send Email", on_click=_send_email):
+        # A new email changes the sidebar and the other tabs, so rerun the whole app
+        st.rerun()
 
-    if st.button("📤 Send Email"):
-        ref_to_use = selected_ref if is_reply and selected_ref else None
-        email = add_email_to_chain(sender, recipient, subject, body, ref_to_use)
+    email = st.session_state.pop('last_sent', None)
+    if email:
         st.success(f"✅ Email sent with reference number: **{email['reference_number']}**")
         st.info(f"📋 Final subject line: **{email['subject']}**")
 
-with tab2:
+
+@st.fragment
+def render_threads_tab():
+    """Threads tab; toggling a thread reruns only this fragment"""
     st.header("Email Threads")
 
     if not st.session_state.email_chains:
         st.info("No emails yet. Compose your first email in the 'Compose Email' tab.")
-    else:
-        # Group emails by reference number
-        references = get_unique_references()
-
-        for ref in sorted(references):
-            with st.expander(f"🔗 Thread: {ref} ({len(get_emails_by_reference(ref))} emails)"):
-                thread_emails = sorted(get_emails_by_reference(ref),
-                                       key=lambda x: x['timestamp'])
-
-                for i, email in enumerate(thread_emails):
-                    st.markdown(f"**Email #{i + 1}** - {email['timestamp'].strftime('%Y-%m-%d %H:%M:%S')}")
-                    st.markdown(f"**From:** {email['sender']}")
-                    st.markdown(f"**To:** {email['recipient']}")
-                    st.markdown(f"**Subject:** {email['subject']}")
+        return
+
+    # Group emails by reference number
+    for ref in get_sorted_references():
+        thread_emails = get_emails_by_reference(ref)
+        with st.expander(f"🔗 Thread: {ref} ({len(thread_emails)} emails)"):
+            # Expander content is sent even while collapsed, so bodies are opt-in
+            show_bodies = st.checkbox("Show email bodies", key=f"open_{ref}")
+
+            # Emails are indexed in send order, so threads are already chronological
+            for i, email in enumerate(thread_emails):
+                st.markdown(f"**Email #{i + 1}** - {format_timestamp(email['timestamp_ns'], '%Y-%m-%d %H:%M:%S')}")
+                st.markdown(f"**From:** {email['sender']}")
+                st.markdown(f"**To:** {email['recipient']}")
+                st.markdown(f"**Subject:** {email['subject']}")
+                if show_bodies:
                     st.markdown(f"**Body:**")
                     st.text_area("", value=email['body'], height=100,
                                  key=f"body_{email['id']}", disabled=True)
-                    st.markdown("---")
+                st.markdown("---")
 
-with tab3:
+
+@st.fragment
+def render_search_tab():
+    """Search tab; selecting a reference reruns only this fragment"""
     st.header("Search by Reference Number")
 
-    if get_unique_references():
-        search_ref = st.selectbox("Select Reference Number to Search:",
-                                  [""] + sorted(get_unique_references()))
-
-        if search_ref:
-            emails = get_emails_by_reference(search_ref)
-            st.success(f"Found {len(emails)} emails with reference {search_ref}")
-
-            # Display search results
-            for i, email in enumerate(sorted(emails, key=lambda x: x['timestamp'])):
-                with st.container():
-                    col1, col2, col3 = st.columns([2, 2, 1])
-                    with col1:
-                        st.write(f"**#{i + 1}:** {email['sender']} → {email['recipient']}")
-                    with col2:
-                        st.write(f"**Subject:** {email['subject']}")
-                    with col3:
-                        st.write(f"**Time:** {email['timestamp'].strftime('%H:%M:%S')}")
-
-                    if st.button(f"View Email #{i + 1}", key=f"view_{email['id']}"):
-                        st.text_area("Email Body:", value=email['body'],
-                                     height=150, key=f"search_body_{email['id']}")
-    else:
+    references = get_sorted_references()
+    if not references:
         st.info("No email threads available to search.")
+        return
 
-# Footer
-st.markdown("---")
-st.markdown("""
-### 💡 How This System Works:
+    search_ref = st.selectbox("Select Reference Number to Search:",
+                              [""] + references)
 
-1. **Automatic Reference Numbers**: Each new email thread gets a unique reference number (GG-LEGAL-YYYY-NNNN format)
-2. **Subject Line Integration**: Reference numbers are automatically added to subject lines
-3. **Thread Tracking**: All replies with the same reference number are grouped together
-4. **Easy Search**: Find any email by its reference number
-5. **Sequential Numbering**: Each reply in a thread can be easily identified by position
+    if search_ref:
+        emails = get_emails_by_reference(search_ref)
+        st.success(f"Found {len(emails)} emails with reference {search_ref}")
 
-### Benefits:
-- ✅ No more scrolling through dozens of emails
-- ✅ Quick reference for clients and team members  
-- ✅ Professional tracking system
-- ✅ Easy handoffs between team members
-- ✅ Audit trail for legal matters
-""")
+        # Display search results
+        for i, email in enumerate(emails):
+            with st.container():
+                col1, col2, col3 = st.columns([2, 2, 1])
+                with col1:
+                    st.write(f"**#{i + 1}:** {email['sender']} → {email['recipient']}")
+                with col2:
+                    st.write(f"**Subject:** {email['subject']}")
+                with col3:
+                    st.write(f"**Time:** {format_timestamp(email['timestamp_ns'], '%H:%M:%S')}")
+
+                if st.button(f"View Email #{i + 1}", key=f"view_{email['id']}"):
+                    st.text_area("Email Body:", value=email['body'],
+                                 height=150, key=f"search_body_{email['id']}")
+
+
+# Streamlit UI
+st.title("📧 Email Reference Number System")
+st.markdown("*POC for Great Gray CIT Legal Team*")
+
+# Sidebar for controls
+st.sidebar.header("📊 System Stats")
+st.sidebar.metric("Total Emails", len(st.session_state.email_chains))
+st.sidebar.metric("Active Threads", len(st.session_state.emails_by_ref))
+st.sidebar.markdown("**Next Reference #**")
+next_ref = format_reference_number(datetime.now().year, st.session_state.next_ref_number)
+st.sidebar.markdown(f'<small>{next_ref}</small>', unsafe_allow_html=True)
+
+if st.sidebar.button("🗑️ Clear All Data", on_click=_clear_all_data):
+    st.success("✅ All data cleared!")
+
+# Main tabs
+tab1, tab2, tab3 = st.tabs(["📝 Compose Email", "📨 Email Threads", "🔍 Search by Reference"])
+
+with tab1:
+    render_compose_tab()
+
+with tab2:
+    render_threads_tab()
+
+with tab3:
+    render_search_tab()
+
+# Footer
+st.markdown("---")
+st.markdown(_FOOTER)